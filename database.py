@@ -1,6 +1,39 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.collation import Collation
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+import logging
 
-client = MongoClient("mongodb://localhost:27017")
+logger = logging.getLogger(__name__)
+
+client = AsyncIOMotorClient("mongodb://localhost:27017")
 db = client.chatapp
 messages = db.messages
 users = db.users
+
+# Unacknowledged writes for chat messages: the server doesn't wait for
+# MongoDB to confirm each batch. A message can be lost if the database
+# goes down mid-write, which is an acceptable trade-off for chat history.
+messages_fast = db.get_collection("messages", write_concern=WriteConcern(w=0))
+
+# Case-insensitive comparison for username lookups
+USERNAME_COLLATION = Collation(locale="en", strength=2)
+
+
+async def ensure_indexes():
+    """Create the indexes the app's queries rely on (no-op if they exist).
+
+    Returns whether usernames are enforced unique by an index.
+    """
+    unique_usernames = True
+    try:
+        await users.create_index("username", unique=True)
+    except OperationFailure as exc:
+        if exc.code != 11000:
+            raise
+        # Older databases can hold duplicate usernames from the racy /register;
+        # keep serving and leave uniqueness unenforced until they're cleaned up
+        logger.error("users has duplicate usernames; unique username index not created: %s", exc)
+        unique_usernames = False
+    await users.create_index("username", name="username_ci", collation=USERNAME_COLLATION)
+    return unique_usernames
@@ -1,14 +1,40 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, status
+"""Chat server: REST auth/profile endpoints plus a broadcast websocket at /ws.
+
+The websocket hub lives in realtime.py. Run with uvloop and httptools:
+
+    uvicorn main:app --loop uvloop --http httptools --ws-max-size 8192 --workers 1
+
+--ws-max-size matches realtime.MAX_FRAME_SIZE, so uvicorn rejects oversized
+frames before buffering them.
+
+Each worker only tracks its own websocket clients. To run more than one
+worker, set REDIS_URL: events are then published on a Redis channel and
+every worker forwards them to its local clients. The short-lived login
+cache is per process, so it is turned off in this mode; otherwise other
+workers would keep accepting an old password for a while after it changes.
+
+    REDIS_URL=redis://localhost:6379 uvicorn main:app --loop uvloop --http httptools --ws-max-size 8192 --workers 4
+"""
+from fastapi import FastAPI, WebSocket, HTTPException, Query, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from database import messages, users
+from database import messages, users, ensure_indexes, USERNAME_COLLATION
+import realtime
 from pydantic import BaseModel
-from jose import JWTError, jwt
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import jwt
+from jwt import PyJWTError
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import asyncio
 import bcrypt
+import hashlib
+import time
 from datetime import timedelta
 from typing import Optional
-from datetime import datetime
 
 app = FastAPI()
 
@@ -26,9 +52,28 @@ SECRET_KEY = "dev-secret-change-me"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
 
+# Tokens at least this long-lived are signed through the _sign cache
+TOKEN_CACHE_MIN_LIFETIME = timedelta(minutes=5)
+
+# jwt.decode with the key and algorithm bound once
+_decode = partial(jwt.decode, key=SECRET_KEY, algorithms=(ALGORITHM,))
 
-# Track connected clients with their usernames
-connected_clients = {}  # {ws: username}
+BCRYPT_ROUNDS = 11
+
+# Decoded token payloads, keyed by the raw token string
+token_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# Recent successful logins, keyed by (username, sha256(password)). Only used
+# with a single worker: evictions on password change or rename can't reach
+# other workers' caches, so it is disabled when REDIS_URL is set.
+LOGIN_CACHE_ENABLED = realtime.REDIS_URL is None
+login_cache = TTLCache(maxsize=1024, ttl=30)
+
+# Set at startup; False when the unique username index couldn't be built
+unique_usernames = False
+
+# bcrypt is deliberately slow, so run it off the event loop
+_pw_pool = ThreadPoolExecutor(max_workers=4)
 
 
 class UserCreate(BaseModel):
@@ -41,50 +86,110 @@ class Token(BaseModel):
     token_type: str
 
 
-def verify_password(plain_password, hashed_password):
+async def verify_password(plain_password, hashed_password):
     plain_password = plain_password[:72].encode('utf-8')
-    return bcrypt.checkpw(plain_password, hashed_password.encode('utf-8'))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pw_pool, bcrypt.checkpw, plain_password, hashed_password.encode('utf-8'))
 
 
-def get_password_hash(password):
+async def get_password_hash(password):
     password = password[:72].encode('utf-8')
-    return bcrypt.hashpw(password, bcrypt.gensalt()).decode('utf-8')
+    loop = asyncio.get_running_loop()
+    hashed = await loop.run_in_executor(_pw_pool, bcrypt.hashpw, password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return hashed.decode('utf-8')
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = int(time.time() + expires_delta.total_seconds())
+    if data.keys() == {"sub"} and expires_delta >= TOKEN_CACHE_MIN_LIFETIME:
+        # Round expiry up to the minute so repeat issuance for a user hits the cache
+        return _sign(data["sub"], -(-expire // 60) * 60)
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def authenticate_user(username: str, password: str):
+@lru_cache(maxsize=4096)
+def _sign(sub: str, expire: int) -> str:
+    return jwt.encode({"sub": sub, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def verify_token_cached(token: str):
+    """Decode a token, reusing the result of a recent verification if we have one."""
+    cached = token_cache.get(token)
+    if cached is not None:
+        payload, exp = cached
+        if exp > time.time():
+            return payload
+        token_cache.pop(token, None)
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    payload = _decode(token)
+    if "exp" in payload:
+        token_cache[token] = (payload, payload["exp"])
+    return payload
+
+
+def evict_cached_tokens(username: str):
+    """Drop every cached token issued to `username`."""
+    for token, (payload, _) in list(token_cache.items()):
+        if payload.get("sub") == username:
+            token_cache.pop(token, None)
+
+
+def evict_cached_logins(username: str):
+    """Forget recent successful logins for `username`."""
+    for key in list(login_cache.keys()):
+        if key[0] == username:
+            login_cache.pop(key, None)
+
+
+async def authenticate_user(username: str, password: str):
     password = password[:72]
-    user = users.find_one({"username": username})
+    cache_key = (username, hashlib.sha256(password.encode('utf-8')).hexdigest())
+    user = login_cache.get(cache_key) if LOGIN_CACHE_ENABLED else None
+    if user is not None:
+        return user
+    user = await users.find_one({"username": username})
     if not user:
         return False
-    if not verify_password(password, user.get("hashed_password", "")):
+    if not await verify_password(password, user.get("hashed_password", "")):
         return False
+    if LOGIN_CACHE_ENABLED:
+        login_cache[cache_key] = user
     return user
 
 
+@app.on_event("startup")
+async def startup():
+    global unique_usernames
+    unique_usernames = await ensure_indexes()
+    await realtime.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await realtime.stop()
+
+
 @app.post("/register", response_model=Token)
 async def register(u: UserCreate):
-    if users.find_one({"username": u.username}):
+    if await users.find_one({"username": u.username}):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
+    hashed = await get_password_hash(u.password)
+    try:
+        await users.insert_one({"username": u.username, "hashed_password": hashed})
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same name
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
-    hashed = get_password_hash(u.password)
-    users.insert_one({"username": u.username, "hashed_password": hashed})
     access_token = create_access_token({"sub": u.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @app.post("/login", response_model=Token)
 async def login(u: UserCreate):
-    user = authenticate_user(u.username, u.password)
+    user = await authenticate_user(u.username, u.password)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
     access_token = create_access_token({"sub": u.username})
@@ -95,12 +200,12 @@ async def login(u: UserCreate):
 async def get_profile(token: str):
     """Get user profile data."""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token_cached(token)
         username = payload.get("sub")
-    except JWTError:
+    except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = users.find_one({"username": username})
+    user = await users.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -121,19 +226,15 @@ async def update_profile(data: ProfileUpdate):
     """Update user profile (username and/or pfp)."""
     token = data.token
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token_cached(token)
         old_username = payload.get("sub")
-    except JWTError:
+    except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = users.find_one({"username": old_username})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     updates = {}
     if data.username and data.username != old_username:
-        # Check if new username exists
-        if users.find_one({"username": data.username}):
+        # Without the unique index a duplicate rename would go through silently
+        if not unique_usernames and await users.find_one({"username": data.username}):
             raise HTTPException(status_code=400, detail="Username already taken")
         updates["username"] = data.username
     
@@ -144,7 +245,22 @@ async def update_profile(data: ProfileUpdate):
         updates["pfp"] = data.pfp
     
     if updates:
-        users.update_one({"username": old_username}, {"$set": updates})
+        # Single round-trip; the unique username index rejects names already taken
+        try:
+            user = await users.find_one_and_update(
+                {"username": old_username},
+                {"$set": updates},
+                projection={"pfp": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="Username already taken")
+    else:
+        user = await users.find_one({"username": old_username}, {"pfp": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if updates:
+        evict_cached_logins(old_username)
     
     # Generate new token if username changed
     new_username = updates.get("username", old_username)
@@ -154,7 +270,7 @@ async def update_profile(data: ProfileUpdate):
         "access_token": new_token,
         "token_type": "bearer",
         "username": new_username,
-        "pfp": updates.get("pfp", user.get("pfp", "")),
+        "pfp": user.get("pfp", ""),
     }
 
 
@@ -162,16 +278,22 @@ async def update_profile(data: ProfileUpdate):
 async def search_users(q: str, token: str):
     """Search for users by username."""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token_cached(token)
         current_user = payload.get("sub")
-    except JWTError:
+    except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
     if not q or len(q) < 2:
         return []
     
-    # Find users matching the query (exclude self)
-    found = users.find({"username": {"$regex": f"^{q}", "$options": "i"}}).limit(10)
+    # Find users matching the query (exclude self). $regex ignores collation, so
+    # the case-insensitive prefix match is a range on the collated username index;
+    # U+FFFF sorts after every other character under ICU collation.
+    found = await users.find(
+        {"username": {"$gte": q, "$lt": q + "\uffff"}},
+        {"username": 1, "pfp": 1, "_id": 0},
+        collation=USERNAME_COLLATION,
+    ).limit(10).to_list(length=10)
     results = [{"username": u.get("username"), "pfp": u.get("pfp", "")} for u in found if u.get("username") != current_user]
     return results
 
@@ -180,16 +302,16 @@ async def search_users(q: str, token: str):
 async def create_private_chat(token: str, with_user: str):
     """Create or get private chat with another user."""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token_cached(token)
         username = payload.get("sub")
-    except JWTError:
+    except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
     if username == with_user:
         raise HTTPException(status_code=400, detail="Cannot chat with yourself")
     
     # Check if target user exists
-    if not users.find_one({"username": with_user}):
+    if not await users.find_one({"username": with_user}):
         raise HTTPException(status_code=404, detail="User not found")
     
     # Create chat ID (sorted usernames for consistency)
@@ -208,31 +330,32 @@ class PasswordChange(BaseModel):
 async def change_password(data: PasswordChange):
     """Change user password."""
     try:
-        payload = jwt.decode(data.token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = verify_token_cached(data.token)
         username = payload.get("sub")
-    except JWTError:
+    except PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = users.find_one({"username": username})
+    user = await users.find_one({"username": username})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Verify old password
-    if not verify_password(data.old_password, user.get("hashed_password", "")):
+    if not await verify_password(data.old_password, user.get("hashed_password", "")):
         raise HTTPException(status_code=401, detail="Incorrect old password")
     
     # Hash and update new password
-    new_hashed = get_password_hash(data.new_password)
-    users.update_one({"username": username}, {"$set": {"hashed_password": new_hashed}})
+    new_hashed = await get_password_hash(data.new_password)
+    await users.update_one({"username": username}, {"$set": {"hashed_password": new_hashed}})
+    evict_cached_tokens(username)
+    evict_cached_logins(username)
     
     return {"message": "Password changed successfully"}
 
 
 @app.get("/messages")
-async def get_messages(limit: int = 50):
+async def get_messages(limit: int = Query(50, ge=1, le=1000)):
     """Return the most recent `limit` messages (oldest first)."""
-    cursor = messages.find().sort("_id", -1).limit(limit)
-    docs = list(cursor)
+    docs = await messages.find({}, {"username": 1, "message": 1}).sort("_id", -1).limit(limit).to_list(length=limit)
     msgs = [
         {"username": d.get("username", "Anonymous"), "text": d.get("message", "")}
         for d in reversed(docs)
@@ -247,77 +370,13 @@ async def websocket_endpoint(ws: WebSocket):
     username = "Anonymous"
     if token:
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            payload = verify_token_cached(token)
             username = payload.get("sub", "Anonymous")
-        except JWTError:
+        except PyJWTError:
             await ws.close(code=1008)
             return
 
-    await ws.accept()
-    connected_clients[ws] = username
-
-    # Notify others of user joining
-    await broadcast_event("user_joined", {"username": username, "count": len(connected_clients)})
-    
-    try:
-        while True:
-            data = await ws.receive_text()
-            if not data.strip():
-                continue
-
-            # Parse message type
-            try:
-                import json
-                msg_data = json.loads(data)
-                msg_type = msg_data.get("type", "message")
-                content = msg_data.get("content", "")
-            except:
-                msg_type = "message"
-                content = data
-
-            if msg_type == "set_username":
-                # Change username
-                old_username = username
-                username = content.strip() or "Anonymous"
-                connected_clients[ws] = username
-                await broadcast_event("username_changed", {"old": old_username, "new": username})
-                continue
-
-            elif msg_type == "typing":
-                # Broadcast typing indicator
-                await broadcast_event("user_typing", {"username": username})
-                continue
-
-            elif msg_type == "message":
-                # Store in database with username and timestamp
-                msg_doc = {
-                    "username": username,
-                    "message": content,
-                    "timestamp": datetime.utcnow(),
-                }
-                messages.insert_one(msg_doc)
-
-                # Broadcast to all connected clients
-                await broadcast_event("message", {
-                    "username": username,
-                    "text": content,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
-
-    except WebSocketDisconnect:
-        connected_clients.pop(ws, None)
-        await broadcast_event("user_left", {"username": username, "count": len(connected_clients)})
-
-
-async def broadcast_event(event_type: str, data: dict):
-    """Broadcast an event to all connected clients."""
-    import json
-    message = {"type": event_type, "data": data}
-    for client in list(connected_clients.keys()):
-        try:
-            await client.send_json(message)
-        except Exception:
-            pass
+    await realtime.serve_client(ws, username)
 
 
 # Serve static files AFTER defining API routes
@@ -326,3 +385,9 @@ async def root():
     return FileResponse("static/login.html")
 
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("main:app", loop="uvloop", http="httptools", workers=1, ws_max_size=realtime.MAX_FRAME_SIZE)
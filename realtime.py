@@ -0,0 +1,344 @@
+"""Websocket hub: connected clients, event fan-out and batched message storage.
+
+Kept apart from the FastAPI routes in main.py so it can be compiled with
+mypyc (FastAPI needs to introspect its route functions, so main.py stays
+interpreted):
+
+    mypyc realtime.py
+
+Python imports the built extension in place of this file when it exists;
+delete it to go back to the interpreted module.
+"""
+from database import messages_fast
+from fastapi import WebSocket, WebSocketDisconnect
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+import asyncio
+import logging
+import orjson
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Track connected clients with their usernames
+connected_clients: Dict[WebSocket, Tuple[str, "asyncio.Queue[bytes]"]] = {}
+CLIENT_QUEUE_SIZE = 256
+MAX_FRAME_SIZE = 8192  # bytes; larger inbound frames close the connection
+
+# Optional Redis pub/sub so events reach clients connected to other workers
+REDIS_URL = os.environ.get("REDIS_URL")
+EVENTS_CHANNEL = "chat:events"
+# Each worker keeps its own client count under a key that expires unless the
+# worker refreshes it, so a worker that exits or dies drops out of the total
+WORKER_ID = uuid.uuid4().hex
+ONLINE_WORKERS_KEY = "chat:online:workers"
+ONLINE_COUNT_KEY = "chat:online:{}"
+ONLINE_COUNT_TTL = 30  # seconds
+ONLINE_HEARTBEAT_INTERVAL = 10  # seconds
+redis: Optional[Redis] = Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# At most one typing broadcast per user in this window
+TYPING_DEBOUNCE = 1.0  # seconds
+last_typing_emit: Dict[str, float] = {}  # {username: loop time of last typing broadcast}
+
+# Joins/leaves are collected and broadcast as one presence event per window
+PRESENCE_FLUSH_DELAY = 0.5  # seconds
+presence_joined: List[str] = []
+presence_left: List[str] = []
+presence_task: Optional["asyncio.Task[None]"] = None
+
+# Chat messages waiting to be written to the database in a batch
+MESSAGE_BATCH_SIZE = 500
+MESSAGE_FLUSH_INTERVAL = 0.05  # seconds
+pending_msgs: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+_background_tasks: List["asyncio.Task[None]"] = []
+
+
+async def start() -> None:
+    """Start the message flush loop and, with Redis configured, the subscriber."""
+    _background_tasks.append(asyncio.create_task(_flush_loop()))
+    if redis is not None:
+        _background_tasks.append(asyncio.create_task(_subscribe_loop()))
+        _background_tasks.append(asyncio.create_task(_heartbeat_loop()))
+
+
+async def stop() -> None:
+    """Stop background tasks and write out any messages still queued."""
+    global presence_task
+    if presence_task is not None:
+        _background_tasks.append(presence_task)
+        presence_task = None
+    for task in _background_tasks:
+        task.cancel()
+    # The flush loop writes out the batch it is holding before it exits
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # Then write out whatever is still queued so no messages are lost on shutdown
+    batch: List[Dict[str, Any]] = []
+    while not pending_msgs.empty():
+        batch.append(pending_msgs.get_nowait())
+    if batch:
+        await _insert_batch(batch)
+    if redis is not None:
+        try:
+            await redis.delete(ONLINE_COUNT_KEY.format(WORKER_ID))
+            await redis.srem(ONLINE_WORKERS_KEY, WORKER_ID)
+        except RedisError:
+            pass
+        await redis.aclose()
+
+
+async def _flush_loop() -> None:
+    """Drain `pending_msgs` into the database with one insert_many per batch."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await pending_msgs.get()]
+        deadline = loop.time() + MESSAGE_FLUSH_INTERVAL
+        try:
+            while len(batch) < MESSAGE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(pending_msgs.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Runs on cancellation too, so a partly collected batch isn't lost
+            await _insert_batch(batch)
+
+
+async def _insert_batch(batch: List[Dict[str, Any]]) -> None:
+    try:
+        # ordered=False so one bad document doesn't abort the rest of the batch
+        await messages_fast.insert_many(batch, ordered=False)
+    except Exception:
+        # Fire-and-forget: a failed batch is dropped rather than killing the flush loop
+        logger.exception("Dropped a batch of %d chat messages", len(batch))
+
+
+async def _handle_setname(ws: WebSocket, username: str, content: str) -> str:
+    """Change the sender's display name."""
+    old_username = username
+    username = content.strip() or "Anonymous"
+    connected_clients[ws] = (username, connected_clients[ws][1])
+    await broadcast_event("username_changed", {"old": old_username, "new": username})
+    return username
+
+
+async def _handle_typing(ws: WebSocket, username: str, content: str) -> str:
+    """Broadcast a typing indicator, coalescing bursts from the same user."""
+    now = asyncio.get_running_loop().time()
+    if now - last_typing_emit.get(username, float("-inf")) < TYPING_DEBOUNCE:
+        return username
+    last_typing_emit[username] = now
+    await broadcast_event("user_typing", {"username": username})
+    return username
+
+
+async def _handle_message(ws: WebSocket, username: str, content: str) -> str:
+    """Queue a chat message for storage and broadcast it."""
+    # Store in database with username and timestamp (unix ms)
+    ts_ms = int(time.time() * 1000)
+    msg_doc: Dict[str, Any] = {
+        "username": username,
+        "message": content,
+        "timestamp": ts_ms,
+    }
+    pending_msgs.put_nowait(msg_doc)
+
+    # Broadcast to all connected clients
+    await broadcast_event("message", {
+        "username": username,
+        "text": content,
+        "timestamp": ts_ms,
+    })
+    return username
+
+
+# Websocket message type -> handler; each returns the (possibly new) username
+HANDLERS: Dict[str, Callable[[WebSocket, str, str], Awaitable[str]]] = {
+    "set_username": _handle_setname,
+    "typing": _handle_typing,
+    "message": _handle_message,
+}
+
+
+async def serve_client(ws: WebSocket, username: str) -> None:
+    """Run an authenticated websocket connection until it closes."""
+    await ws.accept()
+    outbox: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+    connected_clients[ws] = (username, outbox)
+    writer = asyncio.create_task(_writer(ws, outbox))
+
+    # Notify others of user joining
+    joined_as = username
+    mark_presence(joined_as, joined=True)
+    # Tell the new client the current count straight away; a reconnect within
+    # the presence window cancels out and produces no broadcast of its own
+    count = await online_count()
+    outbox.put_nowait(orjson.dumps({"type": "presence", "data": {"count": count, "joined": [], "left": []}}))
+
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # orjson parses bytes directly; text frames are still accepted
+            data = message.get("bytes") or message.get("text") or b""
+            size = len(data) if isinstance(data, bytes) else len(data.encode("utf-8"))
+            if size > MAX_FRAME_SIZE:
+                await ws.close(code=1009)
+                return
+            if not data.strip():
+                continue
+
+            # Parse message type
+            try:
+                msg_data = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                msg_data = None
+            if isinstance(msg_data, dict):
+                msg_type = msg_data.get("type", "message")
+                content = msg_data.get("content", "")
+                if not isinstance(content, str):
+                    # Handlers and storage expect text; non-string JSON (e.g. an
+                    # int too large for BSON) is stored and shown as its JSON form
+                    content = orjson.dumps(content).decode("utf-8")
+            else:
+                msg_type = "message"
+                content = data.decode("utf-8", "replace") if isinstance(data, bytes) else data
+
+            # Unknown (or non-string) types are ignored
+            handler = HANDLERS.get(msg_type) if isinstance(msg_type, str) else None
+            if handler is not None:
+                username = await handler(ws, username, content)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connected_clients.pop(ws, None)
+        last_typing_emit.pop(username, None)
+        writer.cancel()
+        # Record the leave under the join's name so a reconnect still cancels out
+        mark_presence(joined_as, joined=False)
+
+
+async def _writer(ws: WebSocket, outbox: "asyncio.Queue[bytes]") -> None:
+    """Send queued payloads to one client until its connection fails."""
+    while True:
+        payload = await outbox.get()
+        try:
+            await ws.send_bytes(payload)
+        except Exception:
+            break
+
+
+def mark_presence(username: str, joined: bool) -> None:
+    """Record a join/leave and make sure a presence flush is scheduled."""
+    global presence_task
+    (presence_joined if joined else presence_left).append(username)
+    if presence_task is None:
+        presence_task = asyncio.create_task(_flush_presence())
+
+
+async def _flush_presence() -> None:
+    """Broadcast the joins/leaves collected over the last window as one event."""
+    global presence_task
+    await asyncio.sleep(PRESENCE_FLUSH_DELAY)
+    joined = presence_joined[:]
+    left = presence_left[:]
+    presence_joined.clear()
+    presence_left.clear()
+    presence_task = None
+
+    # A user who both joined and left in the window (e.g. a reconnect) cancels out
+    for name in list(left):
+        if name in joined:
+            joined.remove(name)
+            left.remove(name)
+    if not joined and not left:
+        return
+    count = await online_count()
+    await broadcast_event("presence", {"count": count, "joined": joined, "left": left})
+
+
+async def online_count() -> int:
+    """Return the number of connected clients across all workers."""
+    if redis is None:
+        return len(connected_clients)
+    try:
+        await _store_local_count()
+        members = await redis.smembers(ONLINE_WORKERS_KEY)
+        workers = [w.decode("utf-8") if isinstance(w, bytes) else w for w in members]
+        counts = await redis.mget([ONLINE_COUNT_KEY.format(w) for w in workers])
+        gone = [w for w, c in zip(workers, counts) if c is None]
+        if gone:
+            await redis.srem(ONLINE_WORKERS_KEY, *gone)
+    except RedisError:
+        return len(connected_clients)
+    return sum(int(c) for c in counts if c is not None)
+
+
+async def _store_local_count() -> None:
+    """Record this worker's client count and refresh its expiry."""
+    assert redis is not None
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.set(ONLINE_COUNT_KEY.format(WORKER_ID), len(connected_clients), ex=ONLINE_COUNT_TTL)
+        pipe.sadd(ONLINE_WORKERS_KEY, WORKER_ID)
+        await pipe.execute()
+
+
+async def _heartbeat_loop() -> None:
+    """Keep this worker's client count from expiring while it is running."""
+    while True:
+        try:
+            await _store_local_count()
+        except RedisError:
+            pass
+        await asyncio.sleep(ONLINE_HEARTBEAT_INTERVAL)
+
+
+async def broadcast_event(event_type: str, data: Dict[str, Any]) -> None:
+    """Broadcast an event to all connected clients."""
+    # Encode once; every worker forwards the same bytes to its clients
+    payload = orjson.dumps({"type": event_type, "data": data})
+    if redis is None:
+        _deliver_local(payload)
+    else:
+        try:
+            await redis.publish(EVENTS_CHANNEL, payload)
+        except RedisError:
+            # Redis is unavailable; still reach this worker's own clients
+            _deliver_local(payload)
+
+
+async def _subscribe_loop() -> None:
+    """Forward events published by any worker to this worker's clients."""
+    assert redis is not None
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(EVENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        _deliver_local(message["data"])
+        except Exception:
+            # Anything but cancellation (connection drops, timeouts on an idle
+            # listen()) must not end the subscription, or this worker goes deaf
+            logger.exception("Redis subscription failed; resubscribing")
+            await asyncio.sleep(1)
+
+
+def _deliver_local(payload: bytes) -> None:
+    """Queue an encoded event for every client connected to this worker."""
+    for _, outbox in list(connected_clients.values()):
+        try:
+            outbox.put_nowait(payload)
+        except asyncio.QueueFull:
+            # Client isn't keeping up; drop the event rather than block everyone
+            pass